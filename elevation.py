@@ -1,22 +1,57 @@
 import asyncio
-import json
+import hashlib
+import io
+import logging
 import os
+import random
+import sqlite3
 import typing as typ
 from functools import wraps
 from pprint import pprint
 from time import time
+from urllib.parse import quote
 import aiohttp
 
+import ijson
+import numpy as np
+import orjson
 import polyline
-import requests
-
-import geopandas as gpd
 
 from coords_encoder import encode_coords
 from exemple_data import ex_file
 
+logger = logging.getLogger(__name__)
+
+try:
+    # Faster event loop if it is installed, private loops of Elevation are created by its policy.
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
+
+class _StrReader(object):
+    """
+    File-like object for ijson. Gives str as utf-8 bytes part by part,
+    so full encoded copy of the input is not created.
+    """
+    def __init__(self, text: str):
+        self._text = text
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self._text) - self._pos
+        chunk = self._text[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk.encode()
+
 
 def timing(f):
+    # Measure only with TIMING env variable set, otherwise function is returned as is.
+    if not os.environ.get("TIMING"):
+        return f
+
     @wraps(f)
     def wrap(*args, **kw):
         ts = time()
@@ -30,10 +65,45 @@ def timing(f):
 
 class Elevation(object):
     def __init__(self, j_file: typ.Union[str, bytes], api_key: str):
-        self.locations = json.loads(j_file).get("locations")
+        # Locations are streamed one by one, only lat, lon and z are kept.
+        source = _StrReader(j_file) if isinstance(j_file, str) else io.BytesIO(j_file)
+        lats, lons, zs = [], [], []
+        for item in ijson.items(source, "locations.item", use_float=True):
+            lats.append(item["lat"])
+            lons.append(item["lon"])
+            zs.append(item["z"])
+        # (lat, lon) pairs as contiguous float64 array, shape (n, 2).
+        self._coords = np.column_stack((
+            np.array(lats, dtype=np.float64),
+            np.array(lons, dtype=np.float64)
+        ))
+        # Elevations are small range values, float32 is enough for them.
+        self._z = np.array(zs, dtype=np.float32)
         self.api_key = api_key
         # self.google_url = "https://maps.googleapis.com/maps/api/elevation/json?locations=enc:gfo}"
         self.google_url = "https://maps.googleapis.com/maps/api/elevation/json?locations="
+        # Request url = prefix + coords string + suffix
+        self._url_prefix = self.google_url
+        self._url_suffix = f"&key={self.api_key}"
+        # Google accepts at most 512 locations per request.
+        self.batch_size = min(int(os.environ.get("BATCH_SIZE", 512)), 512)
+        # Cached results of make_coords_strings_list and generate_urls.
+        self._c_strs = None
+        self._urls = None
+        # Shared HTTP session. Created lazily on the private event loop and
+        # reused between calls so keep-alive connections are not re-opened.
+        self._loop = None
+        self._connector = None
+        self._session = None
+        self._semaphore = None
+        self.max_concurrency = int(os.environ.get("MAX_CONCURRENCY", 16))
+        self.max_retries = int(os.environ.get("MAX_RETRIES", 3))
+        # On-disk cache of elevations per batch, empty ELEVATION_CACHE disables it.
+        self.cache_path = os.environ.get(
+            "ELEVATION_CACHE", os.path.expanduser("~/.cache/elevation.sqlite")
+        )
+        self._cache = None
+        self._cache_disabled = False
 
     def coords_list(self):
         """
@@ -42,25 +112,7 @@ class Elevation(object):
         """
         # TIME python elevation.py  0,97s user 0,46s system 235% cpu 0,607 total
         # @timing: func:'coords_list' args:[(<__main__.Elevation object at 0x7f7490af25b0>,), {}] took: 0.0027 sec
-        return [
-            (
-                str(item.get("lat")), str(item.get("lon"))
-            ) for item in self.locations
-        ]
-
-    def coords_df(self):
-        """
-        Not Used now
-        Mainly for test time difference between list-comprehension and df in list-comprehension
-        :return:
-        """
-        # TIME python elevation.py  0,98s user 0,47s system 229% cpu 0,633 total
-        # @timing: func:'coords_df' args:[(<__main__.Elevation object at 0x7f8d234515b0>,), {}] took: 0.0065 sec
-        # gdf = gpd.GeoDataFrame(self.locations)
-        # return [tuple(x) for x in gdf[["lat", "lon"]].to_numpy()]
-        # TIME python elevation.py  0,90s user 0,54s system 233% cpu 0,616 total
-        # @timing: func:'coords_df' args:[(<__main__.Elevation object at 0x7fe3323e85b0>,), {}] took: 0.0065 sec
-        return [tuple(x) for x in gpd.GeoDataFrame(self.locations)[["lat", "lon"]].to_numpy()]
+        return self._coords.tolist()
 
     def coords_string(self, coords: list) -> str:
         """
@@ -70,7 +122,7 @@ class Elevation(object):
         :param coords:
         :return:
         """
-        return '|'.join([f"{it[0]}, {it[1]}" for it in coords]).replace(" ", "")
+        return '|'.join(f"{lat},{lon}" for lat, lon in coords)
 
     def create_batch_for_polyline(
             self, batch_size: int = int(os.environ.get("BATCH_SIZE", 100))
@@ -84,17 +136,21 @@ class Elevation(object):
         for ndx in range(0, ln, batch_size):
             yield coords[ndx:min(ndx + batch_size, ln)]
 
-    def batch_coords_to_str(self, batch_size: int = int(os.environ.get("BATCH_SIZE", 300))):
+    def batch_coords_to_str(self, batch_size: typ.Optional[int] = None):
         """
-        Devides coordinates list to batches
-        :param batch_size:
+        Devides coordinates list to batches. Every batch is encoded to polyline
+        https://developers.google.com/maps/documentation/elevation/overview#Locations
+        It is several times shorter than "lat,lon|lat,lon" string so batch can be bigger.
+        Result is already url-encoded, polyline may contain "?", "\\", "`" etc.
+        :param batch_size: by default self.batch_size
         :return:
         """
-        coords = self.coords_list()
-        ln = len(coords)
+        batch_size = batch_size or self.batch_size
+        ln = len(self._coords)
         for ndx in range(0, ln, batch_size):
-            yield self.coords_string(
-                coords[ndx:min(ndx + batch_size, ln)]
+            yield "enc:" + quote(
+                polyline.encode(self._coords[ndx:min(ndx + batch_size, ln)], 5, geojson=False),
+                safe=""
             )
 
     def encode_polyline_list(self) -> list:
@@ -120,104 +176,281 @@ class Elevation(object):
     def make_coords_strings_list(self) -> list:
         """
         list of coordinates strings for used it in request.
+        Computed once, next calls return cached list.
         :return:
         """
-        return [
-            c_str for c_str in self.batch_coords_to_str()
-        ]
+        if self._c_strs is None:
+            self._c_strs = list(self.batch_coords_to_str())
+        return self._c_strs
 
-    # NOTE It can be useful but not now!
-    @staticmethod
-    async def make_async_request(session, url) -> json:
+    def _cache_key(self, url: str) -> str:
         """
-        Async representation of request to the google API
+        Cache key of the batch. Api key is not part of it.
+        :param url: Target url
+        :return: hex digest
+        """
+        return hashlib.blake2b(
+            url[:-len(self._url_suffix)].encode(), digest_size=16
+        ).hexdigest()
+
+    def _cache_disable(self, error: Exception):
+        """
+        Turn the cache off after the first error, requests go to the network.
+        :param error: cache error
+        :return:
+        """
+        logger.warning(f"Elevation cache {self.cache_path} disabled: {error}")
+        self._cache_disabled = True
+        if self._cache is not None:
+            try:
+                self._cache.close()
+            except sqlite3.Error:
+                pass
+            self._cache = None
+
+    def _cache_connect(self) -> typ.Optional[sqlite3.Connection]:
+        """
+        Lazy connection to the cache database.
+        :return: connection or None if cache is disabled or not available
+        """
+        if self._cache_disabled or not self.cache_path:
+            return None
+        if self._cache is None:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                self._cache = sqlite3.connect(self.cache_path)
+                self._cache.execute(
+                    "CREATE TABLE IF NOT EXISTS elevations (key TEXT PRIMARY KEY, value BLOB)"
+                )
+            except (OSError, sqlite3.Error) as e:
+                self._cache_disable(e)
+        return self._cache
+
+    def _cache_get(self, key: str) -> typ.Optional[np.ndarray]:
+        """
+        :param key: see _cache_key
+        :return: float32 array of elevations or None
+        """
+        cache = self._cache_connect()
+        if cache is None:
+            return None
+        try:
+            row = cache.execute("SELECT value FROM elevations WHERE key = ?", (key,)).fetchone()
+        except (OSError, sqlite3.Error) as e:
+            self._cache_disable(e)
+            return None
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _cache_set(self, key: str, elevations: np.ndarray):
+        """
+        :param key: see _cache_key
+        :param elevations: float32 array of elevations
+        :return:
+        """
+        cache = self._cache_connect()
+        if cache is None:
+            return
+        try:
+            with cache:
+                cache.execute(
+                    "INSERT OR REPLACE INTO elevations (key, value) VALUES (?, ?)",
+                    (key, elevations.tobytes())
+                )
+        except (OSError, sqlite3.Error) as e:
+            self._cache_disable(e)
+
+    async def make_async_request(self, session, url) -> typ.Optional[np.ndarray]:
+        """
+        Async representation of request to the google API.
+        Count of simultaneous requests is limited by self.max_concurrency,
+        transient errors (timeouts, connection errors, 429 and 5xx) are retried
+        with jittered exponential backoff.
+        Only elevations are taken from the response so the body can be freed right away.
+        Elevations of the same coordinates do not change, so they are taken from
+        the on-disk cache when possible.
         :param session: Aiohttp Session
         :param url: Target url
-        :return: dict like object
+        :return: float32 array of elevations
+        """
+        key = self._cache_key(url)
+        elevations = self._cache_get(key)
+        if elevations is not None:
+            return elevations
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Semaphore is held only by the request itself, not by backoff sleep.
+                async with self._semaphore:
+                    async with session.get(url) as response:
+                        if response.status == 200:
+                            data = orjson.loads(await response.read())
+                            results = data["results"]
+                            elevations = np.fromiter(
+                                (item["elevation"] for item in results),
+                                dtype=np.float32,
+                                count=len(results)
+                            )
+                            if data.get("status") == "OK":
+                                self._cache_set(key, elevations)
+                            return elevations
+                        if response.status != 429 and response.status < 500:
+                            return None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+            # 429 or 5xx after the last attempt, batch is skipped like other non-200 answers.
+            if attempt == self.max_retries:
+                return None
+            # Exponential backoff with jitter, retries of parallel batches do not come together.
+            await asyncio.sleep(0.1 * 2 ** attempt * (1 + random.random()))
+
+    def _run(self, coro):
+        """
+        Run coroutine on the private event loop of the instance.
+        asyncio.run() closes its loop on exit, so a session created in it can not be reused.
+        :param coro: coroutine
+        :return: coroutine result
+        """
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    async def _session_get(self) -> aiohttp.ClientSession:
+        """
+        Lazy shared aiohttp session with tuned connector (DNS cache, keep-alive).
+        Also creates the semaphore which limits count of simultaneous requests.
+        :return: Aiohttp Session
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._session is None or self._session.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=self.max_concurrency,
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=self._connector,
+                # Per request timeout. Slow batch is retried instead of blocking the rest.
+                timeout=aiohttp.ClientTimeout(total=30, connect=5, sock_read=10),
+                headers={"Accept": "application/json"},
+            )
+        return self._session
+
+    async def aclose(self):
+        """
+        Close shared session and its connector.
+        :return:
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+        self._semaphore = None
+
+    def close(self):
+        """
+        Synchronous shutdown. Close cache, shared session and private event loop.
+        :return:
         """
-        async with session.get(url) as response:
-            if response.status == 200:
-                return await response.json()
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        self._cache_disabled = False
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._run(self.aclose())
+        self._loop.close()
+        self._loop = None
 
-    async def fetch_data(self, urls: list) -> typ.Coroutine:
-        """ Gather many HTTP call made async
+    async def fetch_data(self, session: aiohttp.ClientSession, urls: list, out: np.ndarray) -> np.ndarray:
+        """ Make many HTTP call async. Every batch is written into "out" as soon as it is done,
+        so finished responses are not kept until the slowest one.
         Args:
-            urls: a list of string
+            session: shared aiohttp session (see _session_get)
+            urls: a list of string, url number i contains points from i * self.batch_size
+            out: array for elevations, one item per point
         Return:
-            responses: A list of dict like object containing http response
-        NOTE: Max task timeout 5 min!!! By default to change it use "timeout" variable
-        in ClientSession. Regard to memory leek.
-        """
-        async with aiohttp.ClientSession() as session:
-            tasks = []
-            for url in urls:
-                tasks.append(
-                    self.make_async_request(
-                        session,
-                        url,
-                    )
-                )
-            responses = await asyncio.gather(*tasks, return_exceptions=True)
-            return responses
+            out: elevations array, points of failed batches stay NaN
+        NOTE: Request timeout is 30 sec (see "timeout" variable in _session_get),
+        with retries one batch takes at most about (MAX_RETRIES + 1) * 30 sec.
+        """
+        async def fetch_batch(ndx: int, url: str):
+            # Request, parse and write to out in one step, batches have disjoint slices.
+            try:
+                elevations = await self.make_async_request(session, url)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Url is not logged, it contains api key.
+                logger.warning(f"Batch {ndx} failed: {type(e).__name__}")
+                return
+            if elevations is not None:
+                start = ndx * self.batch_size
+                out[start:start + len(elevations)] = elevations
 
-    def make_request(self, coords_str) -> json:
+        tasks = [
+            fetch_batch(ndx, url) for ndx, url in enumerate(urls)
+        ]
+        for task in asyncio.as_completed(tasks):
+            await task
+        return out
+
+    async def _fetch_urls(self, urls: list) -> np.ndarray:
         """
-        Synchronous version of request to google API
-        :param coords_str: one item from self.make_coords_strings_list
-        :return: JSON object
+        Get shared session and fetch all urls with it.
+        :param urls: a list of string
+        :return: elevations array, one item per point
         """
-        uri = f"{self.google_url}{coords_str}&key={self.api_key}"
-        # print(f"{uri}")
-        # print(f"len {len(uri)}")
-        with requests.get(uri) as resp:
-            return resp
+        session = await self._session_get()
+        out = np.full(len(self._coords), np.nan, dtype=np.float32)
+        return await self.fetch_data(session, urls, out)
 
     def generate_urls(self) -> typ.List[str]:
         """
-        Use in Async requests
+        Use in requests. Computed once, next calls return cached list.
         :return: List with target urls
         """
-        return [
-            f"{self.google_url}{coords_str}&key={self.api_key}"
-            for coords_str in self.make_coords_strings_list()
+        if self._urls is not None:
+            return self._urls
+        urls = [
+            self._url_prefix + coords_str + self._url_suffix
+            for coords_str in self.batch_coords_to_str()
         ]
+        # Google limit for url length is 8192, decrease BATCH_SIZE if it fails.
+        assert all(len(url) < 8192 for url in urls), "URL is too long, decrease BATCH_SIZE"
+        self._urls = urls
+        return urls
 
 
     @timing
-    def get_elevation_from_request(self, resp_res: dict) -> typ.List[str]:
+    def get_google_data(self) -> np.ndarray:
         """
-        Get elevation parameter from etch response.
-        :param resp_res: dict like obj
-        :return: list of elevation params
+        Synchronous version of get_google_data_async: requests are made one by one.
+        Runs on the same shared session, so keep-alive connection is reused.
+        :return: float32 array of elevations, points of failed batches are NaN
         """
-        return [item.get("elevation") for item in resp_res["results"]]
+        session = self._run(self._session_get())
+        out = np.full(len(self._coords), np.nan, dtype=np.float32)
+        for ndx, url in enumerate(self.generate_urls()):
+            try:
+                elevations = self._run(self.make_async_request(session, url))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Same as fetch_data: batch stays NaN, url is not logged, it contains api key.
+                logger.warning(f"Batch {ndx} failed: {type(e).__name__}")
+                continue
+            if elevations is not None:
+                start = ndx * self.batch_size
+                out[start:start + len(elevations)] = elevations
+        return out
 
     @timing
-    def get_google_data(self) -> typ.List[dict]:
+    def get_google_data_async(self) -> np.ndarray:
         """
-        Function to get google data
+        Get google data. Create elevations array in the same order as locations.
+        Points of failed batches are NaN.
         :return:
         """
-        c_strs = self.make_coords_strings_list()
-        # print(f"str len: {len(c_strs)}") # count of requests
-        elevation_list = []
-        for item in c_strs:
-            resp = self.make_request(item)
-            if resp.status_code == 200:
-                elevation_list += self.get_elevation_from_request(resp.json())
-        return elevation_list
-
-    @timing
-    def get_google_data_async(self):
-        """
-        Get google data. Create elevations list.
-        :return:
-        """
-        responses = asyncio.run(self.fetch_data(self.generate_urls()))
-        elevations = []
-        for item in responses:
-            elevations += self.get_elevation_from_request(item)
-        return elevations
+        return self._run(self._fetch_urls(self.generate_urls()))
 
     @timing
     def get_average_elevation(self, asynchronous: bool = False) -> float:
@@ -228,18 +461,16 @@ class Elevation(object):
         It can be when we get not all data from google.
         :return: one float value
         """
-        income_data_df = gpd.GeoDataFrame(self.locations)
-        income_data_df["elevation"] = self.get_google_data() \
-            if not asynchronous \
-            else self.get_google_data_async()
+        elevation = self.get_google_data() if not asynchronous else self.get_google_data_async()
+        received = np.count_nonzero(~np.isnan(elevation))
+        if received != len(self._z):
+            raise ValueError(
+                f"Length of values ({received}) does not match length of index ({len(self._z)})"
+            )
         # This is max not average:
-        # print(income_data_df["z"].max())
-        # print(income_data_df["elevation"].max())
-        # return income_data_df["z"].max() - income_data_df["elevation"].max()
-        # This is average:
-        # print(income_data_df["z"].mean())
-        # print(income_data_df["elevation"].mean())
-        return income_data_df["z"].mean() - income_data_df["elevation"].mean()
+        # return float(self._z.max() - elevation.max())
+        # This is average, values are float32 but sums are accumulated in float64:
+        return float(self._z.mean(dtype=np.float64) - elevation.mean(dtype=np.float64))
 
 
 if __name__ == '__main__':
@@ -258,9 +489,8 @@ if __name__ == '__main__':
     # print(f"Coords str {obj.coords_string()}")
     # print(f"Length of coords string {len(obj.coords_string())}")
     # pprint(obj.get_google_data())
-    # pprint(obj.coords_df())
-    # obj.coords_df()
     # obj.get_google_data()
     # print(obj.get_average_elevation())
     # print(obj.get_google_data_async())
     print(obj.get_average_elevation(asynchronous=True))
+    obj.close()